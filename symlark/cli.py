@@ -5,19 +5,91 @@ __contact__ = 'diane.knappett@stfc.ac.uk'
 __copyright__ = "Copyright 2020 United Kingdom Research and Innovation"
 __license__ = "BSD - see LICENSE file in top-level package directory"
 import sys
-from symlark.symlark import main as symlark_main
+import argparse
+from symlark.symlark import main as symlark_main, SamplingPolicy, CatalogueArchiveBackend, write_catalogue
+from symlark.profiling import Profiler
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="symlark", description="Compare GWS and archive directories and tidy up.")
+    parser.add_argument("dirs", nargs="*", metavar="DIR",
+                        help="GWS and archive directories (or only the archive directory with --write-catalogue)")
+    parser.add_argument("--order", choices=["walk", "cost"], default="walk",
+                        help="Order in which containers are processed: 'walk' (directory order) or "
+                             "'cost' (most reclaimable bytes per unit of verification cost first)")
+    parser.add_argument("--time-budget", type=float, default=None, metavar="SECONDS",
+                        help="Stop cleanly once this many seconds have elapsed")
+    parser.add_argument("--sample-confidence", type=float, default=None, metavar="CONFIDENCE",
+                        help="Verify a random sample of files in each container by checksum, sized to "
+                             "detect corruption with this confidence (e.g. 0.99)")
+    parser.add_argument("--max-corruption-rate", type=float, default=None, metavar="RATE",
+                        help="Smallest fraction of corrupt files that sampling must detect (default: 0.01)")
+    parser.add_argument("--catalogue", default=None, metavar="PATH",
+                        help="Query archive metadata and checksums from a JSON catalogue instead of "
+                             "reading the archive file system")
+    parser.add_argument("--write-catalogue", default=None, metavar="PATH",
+                        help="Build a JSON catalogue for --catalogue from the given archive directory and exit")
+    parser.add_argument("--link-old-versions", action="store_true",
+                        help="Replace older GWS versions that match the same archive version with symlinks "
+                             "instead of deleting them")
+    parser.add_argument("--profile", default=None, metavar="DIR",
+                        help="Write per-phase cProfile output, collapsed stacks for flame graphs and "
+                             "timing spans to this directory")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="With --profile, also write a tracemalloc snapshot for each phase")
+    return parser
 
 
 def main():
     """Console script for symlark."""
-    args = sys.argv[1:]
+    parser = get_parser()
+    args = parser.parse_args(sys.argv[1:])
 
-    if len(args) != 2:
+    if args.write_catalogue:
+        if len(args.dirs) != 1:
+            parser.error("--write-catalogue takes a single archive directory")
+        write_catalogue(args.dirs[0], args.write_catalogue)
+        print(f"Catalogue written to: {args.write_catalogue}")
+        return
+
+    if len(args.dirs) != 2:
         print("[ERROR] Must provide 'gws' and 'archive' directories as 2 command-line arguments.")
         sys.exit(0)
 
-    gws_dir, arc_dir = args
-    symlark_main(gws_dir, arc_dir)
+    sampling = None
+    if args.sample_confidence is not None:
+        max_corruption_rate = 0.01 if args.max_corruption_rate is None else args.max_corruption_rate
+        try:
+            sampling = SamplingPolicy(args.sample_confidence, max_corruption_rate)
+        except ValueError as exc:
+            parser.error(str(exc))
+    elif args.max_corruption_rate is not None:
+        parser.error("--max-corruption-rate can only be used with --sample-confidence")
+
+    backend = None
+    if args.catalogue:
+        try:
+            backend = CatalogueArchiveBackend(args.catalogue)
+        except (OSError, ValueError) as exc:
+            parser.error(f"Cannot read catalogue {args.catalogue}: {exc}")
+
+    if args.profile_memory and not args.profile:
+        parser.error("--profile-memory can only be used with --profile")
+
+    profiler = Profiler(args.profile, trace_malloc=args.profile_memory)
+
+    gws_dir, arc_dir = args.dirs
+    try:
+        summary = symlark_main(gws_dir, arc_dir, order=args.order, time_budget=args.time_budget,
+                               sampling=sampling, backend=backend,
+                               link_old_versions=args.link_old_versions, profiler=profiler)
+
+        for line in summary.report():
+            print(line)
+    finally:
+        # Profiles of a failed run are the most useful ones to keep
+        for path in profiler.close():
+            print(f"Profile written to: {path}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+"""Profiling hooks for symlark runs."""
+
+__author__ = """Diane Knappett"""
+__contact__ = 'diane.knappett@stfc.ac.uk'
+__copyright__ = "Copyright 2020 United Kingdom Research and Innovation"
+__license__ = "BSD - see LICENSE file in top-level package directory"
+
+import os, time
+import cProfile
+import pstats
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Stacks whose share of a function's time falls below this (in seconds) are not expanded
+MIN_STACK_TIME = 1e-6
+MAX_STACK_DEPTH = 128
+
+
+def _label(func: tuple) -> str:
+    fname, line, name = func
+    if fname == "~":
+        return name
+    return f"{os.path.basename(fname)}:{name}:{line}"
+
+
+def collapse_stats(stats: pstats.Stats) -> dict:
+    # Convert cProfile caller/callee data into collapsed stacks ("a;b;c" -> seconds).
+    # cProfile only records direct callers, so a callee's time is split between
+    # the stacks it appears in according to the time recorded for each caller.
+    entries = stats.stats
+    callees = defaultdict(dict)
+
+    for func, (cc, nc, tt, ct, callers) in entries.items():
+        for caller, caller_stats in callers.items():
+            callees[caller][func] = caller_stats[3]
+
+    stacks = defaultdict(float)
+
+    def walk(func, stack, on_stack, frac):
+        tt, ct = entries[func][2], entries[func][3]
+        stacks[stack] += tt * frac
+
+        if len(on_stack) >= MAX_STACK_DEPTH:
+            return
+
+        for callee, via in callees[func].items():
+            callee_ct = entries[callee][3]
+            if callee in on_stack or callee_ct <= 0 or frac * via < MIN_STACK_TIME:
+                continue
+            walk(callee, f"{stack};{_label(callee)}", on_stack | {callee}, frac * via / callee_ct)
+
+    for func, (cc, nc, tt, ct, callers) in entries.items():
+        if not callers:
+            walk(func, _label(func), {func}, 1.0)
+
+    return stacks
+
+
+def write_collapsed(stacks: dict, path: str) -> None:
+    # Write collapsed stacks in the format read by flamegraph.pl, inferno and speedscope,
+    # with each value in microseconds
+    with open(path, "w") as writer:
+        for stack, seconds in sorted(stacks.items()):
+            micros = int(round(seconds * 1e6))
+            if micros > 0:
+                writer.write(f"{stack} {micros}\n")
+
+
+class Profiler:
+    def __init__(self, out_dir: str=None, trace_malloc: bool=False):
+        self.out_dir = out_dir
+        self.enabled = out_dir is not None
+        self.trace_malloc = trace_malloc and self.enabled
+        self._started_tracing = False
+        self._profiles = {}
+        self._snapshots = {}
+        self._stack = []
+        self._span_times = defaultdict(float)
+
+    @contextmanager
+    def span(self, name: str):
+        # Time a block and record its self time against the current stack of spans
+        if not self.enabled:
+            yield
+            return
+
+        frame = [name.replace(";", "_").replace(" ", "_"), 0.0]
+        self._stack.append(frame)
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stack.pop()
+            self._span_times[";".join(["symlark"] + [f[0] for f in self._stack] + [frame[0]])] += elapsed - frame[1]
+
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    @contextmanager
+    def phase(self, name: str):
+        # A top-level span that is also captured by cProfile (and optionally tracemalloc)
+        if not self.enabled:
+            yield
+            return
+
+        profile = self._profiles.setdefault(name, cProfile.Profile())
+        if self.trace_malloc:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            # Only keep allocations made during this phase
+            tracemalloc.clear_traces()
+
+        with self.span(name):
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                if self.trace_malloc:
+                    self._snapshots[name] = tracemalloc.take_snapshot()
+
+    def close(self) -> list:
+        # Write all captured profiles to the output directory and return their paths
+        if not self.enabled:
+            return []
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        written = []
+
+        for name, profile in self._profiles.items():
+            prof_path = os.path.join(self.out_dir, f"{name}.prof")
+            profile.dump_stats(prof_path)
+
+            collapsed_path = os.path.join(self.out_dir, f"{name}.collapsed")
+            write_collapsed(collapse_stats(pstats.Stats(profile)), collapsed_path)
+            written.extend([prof_path, collapsed_path])
+
+        for name, snapshot in self._snapshots.items():
+            snapshot_path = os.path.join(self.out_dir, f"{name}.tracemalloc")
+            snapshot.dump(snapshot_path)
+            written.append(snapshot_path)
+
+            for stat in snapshot.statistics("lineno")[:5]:
+                logger.debug(f"Top memory allocation in {name}: {stat}")
+
+        # Leave tracing running if it was started by the caller
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+        spans_path = os.path.join(self.out_dir, "spans.collapsed")
+        write_collapsed(self._span_times, spans_path)
+        written.append(spans_path)
+
+        return written
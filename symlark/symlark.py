@@ -5,10 +5,16 @@ __contact__ = 'diane.knappett@stfc.ac.uk'
 __copyright__ = "Copyright 2020 United Kingdom Research and Innovation"
 __license__ = "BSD - see LICENSE file in top-level package directory"
 
-import os, glob, re
+import os, glob, re, time
 import hashlib
+import json
+import math
+import random
+from abc import ABC, abstractmethod
 from pathlib import Path
 
+from symlark.profiling import Profiler
+
 import logging
 
 # Set up module-level logger
@@ -17,6 +23,88 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+class TimeBudgetExceeded(Exception):
+    pass
+
+
+def check_deadline(deadline: float, where: str) -> None:
+    # Raised before any further reading or deleting, so a container is left untouched
+    # from the point the deadline passes
+    if deadline is not None and time.monotonic() >= deadline:
+        raise TimeBudgetExceeded(f"Time budget exhausted, stopping in: {where}")
+
+
+class RunSummary:
+    def __init__(self):
+        self.containers_processed = 0
+        self.containers_invalid = 0
+        self.containers_over_budget = 0
+        self.bytes_reclaimed = 0
+        self.budget_exhausted = False
+        self.containers_sampled = 0
+        self.sample_escalations = 0
+        self.min_confidence = None
+        self.same_inode_matches = 0
+        self.archive_link_matches = 0
+        self.index_hits = 0
+
+    def record_sample(self, confidence: float, escalated: bool) -> None:
+        self.containers_sampled += 1
+        if escalated:
+            self.sample_escalations += 1
+        elif self.min_confidence is None or confidence < self.min_confidence:
+            self.min_confidence = confidence
+
+    def report(self) -> list:
+        lines = [f"Containers processed: {self.containers_processed}",
+                 f"Containers skipped (invalid archive): {self.containers_invalid}",
+                 f"Containers skipped (time budget): {self.containers_over_budget}",
+                 f"Bytes reclaimed: {self.bytes_reclaimed}"]
+        if self.containers_sampled:
+            lines.append(f"Containers verified by sampling: {self.containers_sampled} "
+                         f"({self.sample_escalations} escalated to full verification)")
+        if self.same_inode_matches or self.archive_link_matches:
+            lines.append(f"Files matched without hashing: {self.same_inode_matches} by inode, "
+                         f"{self.archive_link_matches} by symlink into archive")
+        if self.index_hits:
+            lines.append(f"Checksums reused from content index: {self.index_hits}")
+        if self.min_confidence is not None:
+            lines.append(f"Lowest sampling confidence achieved: {self.min_confidence:.4f}")
+        if self.budget_exhausted:
+            lines.append("Time budget exhausted before all containers were processed")
+        return lines
+
+
+class SamplingPolicy:
+    def __init__(self, confidence: float=0.95, max_corruption_rate: float=0.01, seed=None):
+        if not 0 < confidence < 1:
+            raise ValueError(f"Sampling confidence must be between 0 and 1: {confidence}")
+        if not 0 < max_corruption_rate <= 1:
+            raise ValueError(f"Maximum corruption rate must be between 0 and 1: {max_corruption_rate}")
+
+        self.confidence = confidence
+        self.max_corruption_rate = max_corruption_rate
+        self.rng = random.Random(seed)
+
+    def sample_size(self, n_files: int) -> tuple:
+        # Smallest sample that would contain at least one corrupt file with the requested
+        # confidence, if at least `max_corruption_rate` of the files were corrupt.
+        # Sampling is without replacement, so the miss probability is hypergeometric.
+        # Returns (sample size, confidence achieved).
+        if n_files == 0:
+            return 0, 1.0
+
+        n_bad = max(1, math.ceil(self.max_corruption_rate * n_files))
+        p_miss = 1.0
+
+        for i in range(n_files):
+            p_miss *= (n_files - n_bad - i) / (n_files - i)
+            if 1 - p_miss >= self.confidence:
+                return i + 1, 1 - p_miss
+
+        return n_files, 1.0
+
+
 def nested_list(d: str, remove_base=False) -> list:
     paths = []
 
@@ -24,7 +112,7 @@ def nested_list(d: str, remove_base=False) -> list:
         pth = os.path.join(d, i)
 
         if os.path.isdir(pth):
-            paths.extend(nested_list(pth, remove_base=pth))
+            paths.extend(nested_list(pth, remove_base=remove_base))
         else:
             if remove_base:
                 pth = pth.replace(remove_base, "").lstrip("/")
@@ -34,37 +122,238 @@ def nested_list(d: str, remove_base=False) -> list:
     return sorted(paths)
 
 
-def dirs_match(d1: str, d2: str, basedir1: str, basedir2: str) -> bool:
+class ArchiveBackend(ABC):
+    # Interface for querying the archive. Every query covers a whole container or
+    # version directory so that remote catalogues can answer in a single call.
+
+    @abstractmethod
+    def exists(self, dr: str) -> bool:
+        pass
+
+    @abstractmethod
+    def versions(self, dr: str) -> list:
+        pass
+
+    @abstractmethod
+    def latest(self, dr: str):
+        pass
+
+    @abstractmethod
+    def list_files(self, version_dir: str) -> dict:
+        # Map of relative path -> size in bytes for every file in a version directory
+        pass
+
+    @abstractmethod
+    def checksums(self, version_dir: str, relpaths: list) -> dict:
+        # Map of relative path -> MD5 checksum for the requested files
+        pass
+
+    def identities(self, version_dir: str, relpaths: list) -> dict:
+        # Map of relative path -> (device, inode) for the requested files, where known
+        return {}
+
+
+class PosixArchiveBackend(ArchiveBackend):
+    # Archive mounted as a POSIX file system and read file by file. Checksums are
+    # looked up in, and added to, a ContentIndex when one is given.
+
+    def __init__(self, index=None):
+        self.index = index
+
+    def exists(self, dr: str) -> bool:
+        return os.path.isdir(dr)
+
+    def versions(self, dr: str) -> list:
+        return find_versions(dr)
+
+    def latest(self, dr: str):
+        latest_path = Path(f"{dr}/latest")
+        return latest_path.readlink().as_posix() if latest_path.is_symlink() else False
+
+    def list_files(self, version_dir: str) -> dict:
+        return {i: size(os.path.join(version_dir, i)) for i in nested_list(version_dir, remove_base=version_dir)}
+
+    def checksums(self, version_dir: str, relpaths: list) -> dict:
+        # Files are only read when their checksum is first looked up, so callers can
+        # stop part way through (e.g. at a deadline) without reading the rest
+        return _LazyChecksums(version_dir, relpaths, self.index.md5 if self.index else md5)
+
+    def identities(self, version_dir: str, relpaths: list) -> dict:
+        ids = {}
+        for i in relpaths:
+            st = os.stat(os.path.join(version_dir, i))
+            ids[i] = (st.st_dev, st.st_ino)
+        return ids
+
+
+class _LazyChecksums(dict):
+    def __init__(self, version_dir: str, relpaths: list, checksum):
+        super().__init__()
+        self._version_dir = version_dir
+        self._relpaths = set(relpaths)
+        self._checksum = checksum
+
+    def __missing__(self, i):
+        if i not in self._relpaths:
+            raise KeyError(i)
+        self[i] = self._checksum(os.path.join(self._version_dir, i))
+        return self[i]
+
+
+class CatalogueArchiveBackend(ArchiveBackend):
+    # Archive described by a JSON catalogue, standing in for a catalogue service.
+    # The catalogue maps each container path to its versions and file metadata:
+    #   {"<container>": {"latest": "v20220203",
+    #                    "versions": {"v20220203": {"<relpath>": {"size": 3, "md5": "..."}}}}}
+
+    def __init__(self, catalogue: str):
+        with open(catalogue) as reader:
+            self.containers = json.load(reader)
+
+        if not isinstance(self.containers, dict):
+            raise ValueError("Catalogue must map container paths to their versions")
+
+    def exists(self, dr: str) -> bool:
+        dr = dr.rstrip("/")
+        return any(cont == dr or cont.startswith(dr + "/") for cont in self.containers)
+
+    def versions(self, dr: str) -> list:
+        return sorted(self.containers.get(dr, {}).get("versions", {}))
+
+    def latest(self, dr: str):
+        return self.containers.get(dr, {}).get("latest") or False
+
+    def _files(self, version_dir: str) -> dict:
+        dr, version = os.path.split(version_dir)
+        return self.containers.get(dr, {}).get("versions", {}).get(version, {})
+
+    def list_files(self, version_dir: str) -> dict:
+        return {i: meta["size"] for i, meta in self._files(version_dir).items()}
+
+    def checksums(self, version_dir: str, relpaths: list) -> dict:
+        files = self._files(version_dir)
+        return {i: files[i]["md5"] for i in relpaths}
+
+
+def write_catalogue(base_dir: str, catalogue: str) -> None:
+    # Build a JSON catalogue from a POSIX archive, for use with CatalogueArchiveBackend
+    posix = PosixArchiveBackend()
+    base_dir = os.path.abspath(base_dir)
+    containers = {}
+
+    for dr in identify_dirs(base_dir):
+        versions = {}
+        for version in posix.versions(dr):
+            version_dir = os.path.join(dr, version)
+            sizes = posix.list_files(version_dir)
+            sums = posix.checksums(version_dir, list(sizes))
+            versions[version] = {i: {"size": sizes[i], "md5": sums[i]} for i in sizes}
+
+        containers[dr] = {"latest": posix.latest(dr), "versions": versions}
+
+    with open(catalogue, "w") as writer:
+        json.dump(containers, writer, indent=2)
+
+
+def dirs_match(d1: str, d2: str, basedir1: str, basedir2: str,
+               sampling: SamplingPolicy=None, summary: RunSummary=None,
+               backend: ArchiveBackend=None, index=None, deadline: float=None) -> bool:
+    backend = backend or PosixArchiveBackend(index=index)
+    checksum = index.md5 if index else md5
     errs = 0
     l1 = nested_list(d1, remove_base=d1)
-    l2 = nested_list(d2, remove_base=d2)
+    arc_sizes = backend.list_files(d2)
+    l2 = sorted(arc_sizes)
 
 
     if l1 != l2:
         logger.error(f"Dirs have different listed contents: {d1} vs {d2}")
         return
 
+    to_hash = []
+
     for i in l1:
         i1 = os.path.join(d1, i)
         i2 = os.path.join(d2, i)
         logger.debug(f"Comparing file in source and target dirs: {i}")
 
         if os.path.isfile(i1) or os.path.islink(i1):
-            s1, s2 = [size(item) for item in (i1, i2)]
+            s1, s2 = size(i1), arc_sizes[i]
 
             if s1 != s2:
                 logger.error(f"Files differ in size: {i1} = {s1} vs {i2} = {s2}")
                 errs += 1
             else:
-                m1, m2 = [md5(item) for item in (i1, i2)]
-                if m1 != m2:
-                    logger.error(f"Files differ in MD5: {i1} vs {i2}")
-                    errs += 1
+                to_hash.append(i)
+
+    to_hash = _drop_identical(d1, d2, to_hash, backend, summary)
+
+    if sampling and errs == 0:
+        n_sample, confidence = sampling.sample_size(len(to_hash))
+        sample = sampling.rng.sample(to_hash, n_sample)
+        logger.debug(f"Verifying {n_sample} of {len(to_hash)} files by checksum in: {d1}")
+
+        arc_sums = backend.checksums(d2, sample)
+        escalated = False
+        for i in sample:
+            check_deadline(deadline, d1)
+            if checksum(os.path.join(d1, i)) != arc_sums[i]:
+                escalated = True
+                break
+
+        if summary:
+            summary.record_sample(confidence, escalated)
+
+        if not escalated:
+            logger.info(f"Sample of {n_sample} files matched with confidence {confidence:.4f} in: {d1}")
+            return True
+
+        logger.warning(f"Checksum mismatch in sample, escalating to full verification: {d1}")
+
+    arc_sums = backend.checksums(d2, to_hash)
+
+    for i in to_hash:
+        check_deadline(deadline, d1)
+        i1, i2 = os.path.join(d1, i), os.path.join(d2, i)
+        if checksum(i1) != arc_sums[i]:
+            logger.error(f"Files differ in MD5: {i1} vs {i2}")
+            errs += 1
 
     res = True if errs == 0 else False
     return res    
 
 
+def _drop_identical(d1: str, d2: str, relpaths: list, backend: ArchiveBackend, summary: RunSummary=None) -> list:
+    # Remove files that are known to be the archive copy without reading them:
+    # GWS symlinks that resolve into the archive version, and files sharing a (device, inode)
+    arc_real = os.path.realpath(d2)
+    remaining = []
+
+    for i in relpaths:
+        if os.path.realpath(os.path.join(d1, i)) in (os.path.join(d2, i), os.path.join(arc_real, i)):
+            logger.debug(f"File is a symlink into the archive, skipping checksum: {i}")
+            if summary:
+                summary.archive_link_matches += 1
+        else:
+            remaining.append(i)
+
+    # Only files with more than one link can share an inode with the archive copy
+    gws_stats = {i: os.stat(os.path.join(d1, i)) for i in remaining}
+    arc_ids = backend.identities(d2, [i for i in remaining if gws_stats[i].st_nlink > 1])
+    relpaths, remaining = remaining, []
+
+    for i in relpaths:
+        st = gws_stats[i]
+        if arc_ids.get(i) == (st.st_dev, st.st_ino):
+            logger.debug(f"File has the same inode as the archive copy, skipping checksum: {i}")
+            if summary:
+                summary.same_inode_matches += 1
+        else:
+            remaining.append(i)
+
+    return remaining
+
+
 def delete_dir(dr):
     logger.warning(f"Deleting files in: {dr}")
     for fname in os.listdir(dr):
@@ -96,6 +385,30 @@ def md5(f: str, blocksize: int=65536) -> str:
     return hash.hexdigest()
 
 
+class ContentIndex:
+    # Checksums keyed by file identity and state (device, inode, size, mtime), shared
+    # across the versions of a container so that files unchanged between versions
+    # (e.g. hardlinked into the next version) are only read once
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self._digests = {}
+        self.hits = 0
+
+    def md5(self, f: str) -> str:
+        st = os.stat(f)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+        if key in self._digests:
+            self.hits += 1
+            logger.debug(f"Reusing indexed MD5 checksum for: {f}")
+        else:
+            self._digests[key] = md5(f)
+
+        return self._digests[key]
+
+
 def size(f: str) -> int:
     return os.path.getsize(f)
 
@@ -121,17 +434,17 @@ class VersionDir:
 
 
 class ArchiveDir:
-    def __init__(self, dr):
+    def __init__(self, dr, backend: ArchiveBackend=None):
         self.dr = dr
-        self.exists = os.path.isdir(dr)
-        self.versions = find_versions(dr)
-        self._latest_path = Path(f"{dr}/latest")
-        self.latest = self._latest_path.readlink().as_posix() if self._latest_path.is_symlink() else False
+        self.backend = backend or PosixArchiveBackend()
+        self.exists = self.backend.exists(dr)
+        self.versions = self.backend.versions(dr)
+        self.latest = self.backend.latest(dr)
         self._check_valid()
 
     def _check_valid(self):
         valid = True
-        if not os.path.isdir(self.dr):
+        if not self.exists:
             valid = False
             logger.error(f"Archive container directory is missing: {self.dr}")
         elif not self.versions:
@@ -141,97 +454,267 @@ class ArchiveDir:
         if not self.latest:
             valid = False
             logger.error(f"No latest link in container directory: {self.dr}")
-        elif self._latest_path.readlink().as_posix() != self.versions[-1]:
+        elif not self.versions or self.latest != self.versions[-1]:
             valid = False
             logger.error(f"Latest link is not pointing to most recent version in: {self.dr}")
 
         self.valid = valid
 
 
-def main(base_dir1: str, base_dir2: str) -> None:
+# Relative cost of handling a single file, expressed in bytes read, so that
+# containers with many small files are not treated as free to verify
+PER_FILE_COST = 65536
 
-    for dr in (base_dir1, base_dir2):
-        if not os.path.isdir(dr):
-            logger.error(f"Top-level directory does not exist: {dr}")
-            return
 
-    # Ensure paths are absolute, not relative, so that they can be used to create symlinks
-    base_dir1 = os.path.abspath(base_dir1)
-    base_dir2 = os.path.abspath(base_dir2)
+# Count files, total bytes and reclaimable bytes under a directory using only the listing
+# (no file contents are read). A file only frees space if every hardlink to it is inside
+# the directory, so a file hardlinked to the archive copy is not reclaimable. Symlinks
+# free no data and are not counted as reclaimable.
+def dir_usage(d: str) -> tuple:
+    inodes = {}
+    nfiles, nbytes = _scan_usage(d, inodes)
+    return nfiles, nbytes, reclaimable_bytes(inodes)
 
-    gws_dirs_to_check = identify_dirs(base_dir1)
 
-    if not gws_dirs_to_check:
-        logger.error(f"No content found in directory: {base_dir1}")
+def _scan_usage(d: str, inodes: dict) -> tuple:
+    nfiles, nbytes = 0, 0
+
+    with os.scandir(d) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                sub_files, sub_bytes = _scan_usage(entry.path, inodes)
+                nfiles += sub_files
+                nbytes += sub_bytes
+            else:
+                st = entry.stat(follow_symlinks=False)
+                nfiles += 1
+                nbytes += st.st_size
+                if not entry.is_symlink():
+                    # [links seen, total links, size] for each (device, inode)
+                    links = inodes.setdefault((st.st_dev, st.st_ino), [0, st.st_nlink, st.st_size])
+                    links[0] += 1
+
+    return nfiles, nbytes
 
-    for d1 in gws_dirs_to_check:
-        gws_dir = VersionDir(d1)
-        gws_versions = find_versions(gws_dir.dr)
 
-        arc_dir = ArchiveDir(d1.replace(base_dir1, base_dir2))
-        arc_versions = find_versions(arc_dir.dr)
+def reclaimable_bytes(inodes: dict) -> int:
+    return sum(size for seen, nlink, size in inodes.values() if seen >= nlink)
 
-        # If archive dir is invalid then needs fixing before other checks can be done
-        if not arc_dir.valid:
+
+class ContainerEstimate:
+    def __init__(self, dr, reclaimable=0, cost=0):
+        self.dr = dr
+        self.reclaimable = reclaimable
+        self.cost = cost
+
+    @property
+    def score(self) -> float:
+        # Reclaimable bytes per unit of verification cost
+        return self.reclaimable / max(self.cost, 1)
+
+
+def estimate_container(gws_path: str, arc_path: str, backend: ArchiveBackend=None,
+                       link_old_versions: bool=False) -> ContainerEstimate:
+    est = ContainerEstimate(gws_path)
+    backend = backend or PosixArchiveBackend()
+    latest = backend.latest(arc_path)
+
+    if not latest:
+        return est
+
+    # Older versions that will be compared against the archive are costed like the latest
+    verified = set(backend.versions(arc_path)) if link_old_versions else set()
+    inodes = {}
+
+    for version in find_versions(gws_path):
+        gv_path = os.path.join(gws_path, version)
+        if os.path.islink(gv_path) or version > latest:
             continue
 
-        # Check that most recent archive version is not greater than most recent GWS version
-        # If it is then create a symlink in the GWS and rerun identify_dirs list (or prefix it)
-        most_recent_arc = (list(reversed(arc_versions))[0])
-        most_recent_gws = (list(reversed(gws_versions))[0])
-        if most_recent_arc > most_recent_gws:
-            logger.warning("Most recent archive version directory newer than most recent GWS version directory.")
-            # Create symlink from GWS to archive
-            gv_path, av_path = [os.path.join(bdir, most_recent_arc) for bdir in (gws_dir.dr, arc_dir.dr)]
-            symlink(av_path, gv_path)
-            # Append the new GWS symlink version to the gws_versions list
-            gws_versions.append(os.path.basename(gv_path))
-
-        # Loop through all GWS versions and check them
-        for gws_version in reversed(gws_versions):
-            gv_path, av_path = [os.path.join(bdir, gws_version) for bdir in (gws_dir.dr, arc_dir.dr)]
-            logger.debug(f"[INFO] Working on: {gv_path}")
-            logger.debug(f"              and: {av_path}")
-
-            # If the GWS version is older than the latest archive version: delete the GWS version
-            if gws_version < arc_dir.latest:
-                if os.path.islink(gv_path):
-                    os.remove(gv_path)
-                    logger.warning(f"[ACTION] Deleted symlink to older version: {gv_path}")
-                else:
-                    delete_dir(gv_path)
-                    logger.warning(f"[ACTION] Deleted old version in GWS: {gv_path}")
-            
-            # If they are the same:
-            elif gws_version == arc_dir.latest:
-
-                # TODO: find a better solution than ".endswith(av_path)" - should match equivalence
-                if Path(gv_path).is_symlink(): #and Path(gv_path).readlink().as_posix().endswith(av_path):
-                    logger.info(f"{gv_path} correctly points to: {av_path}")
-                elif dirs_match(gv_path, av_path, base_dir1, base_dir2):
-                    logger.info(f"Found matching directories, so deleting and symlinking.")
-                    delete_dir(gv_path)
-                    symlink(av_path, gv_path)
-                    logger.warning(f"[ACTION] Deleted {gv_path} and symlinked to: {av_path}")
+        nfiles, nbytes = _scan_usage(gv_path, inodes)
+
+        if version == latest or version in verified:
+            # Both copies are read in full to compare checksums
+            est.cost += 2 * nbytes + nfiles * PER_FILE_COST
+        else:
+            est.cost += nfiles
 
-                arc_latest_link=Path(arc_dir.dr + '/latest')
-                logger.warning(f"    Archive latest link points to {arc_latest_link.readlink()}")
+    # Versions of the container are removed together, so hardlinks between them still free space
+    est.reclaimable = reclaimable_bytes(inodes)
+    return est
 
-                gws_latest_link=Path(gws_dir.dr + '/latest')
-                if os.path.exists(gws_latest_link):
-                    logger.warning(f"    GWS latest link points to {gws_latest_link.readlink()}")
-                    os.remove(gws_latest_link.as_posix())
+
+def order_by_cost(gws_dirs: list, base_dir1: str, base_dir2: str, backend: ArchiveBackend=None,
+                  link_old_versions: bool=False) -> list:
+    estimates = [estimate_container(d1, d1.replace(base_dir1, base_dir2), backend=backend,
+                                    link_old_versions=link_old_versions) for d1 in gws_dirs]
+    return sorted(estimates, key=lambda est: est.score, reverse=True)
+
+
+def process_container(d1: str, base_dir1: str, base_dir2: str, summary: RunSummary,
+                      sampling: SamplingPolicy=None, backend: ArchiveBackend=None,
+                      link_old_versions: bool=False, deadline: float=None, index=None) -> None:
+    # Checksums are shared between versions of this container only
+    index = index or ContentIndex()
+    index.clear()
+
+    gws_dir = VersionDir(d1)
+    gws_versions = find_versions(gws_dir.dr)
+
+    arc_dir = ArchiveDir(d1.replace(base_dir1, base_dir2), backend=backend or PosixArchiveBackend(index=index))
+    arc_versions = arc_dir.versions
+
+    # If archive dir is invalid then needs fixing before other checks can be done
+    if not arc_dir.valid:
+        summary.containers_invalid += 1
+        return
+
+    summary.containers_processed += 1
+
+    # Check that most recent archive version is not greater than most recent GWS version
+    # If it is then create a symlink in the GWS and rerun identify_dirs list (or prefix it)
+    most_recent_arc = (list(reversed(arc_versions))[0])
+    most_recent_gws = (list(reversed(gws_versions))[0])
+    if most_recent_arc > most_recent_gws:
+        logger.warning("Most recent archive version directory newer than most recent GWS version directory.")
+        # Create symlink from GWS to archive
+        gv_path, av_path = [os.path.join(bdir, most_recent_arc) for bdir in (gws_dir.dr, arc_dir.dr)]
+        symlink(av_path, gv_path)
+        # Append the new GWS symlink version to the gws_versions list
+        gws_versions.append(os.path.basename(gv_path))
+
+    # Loop through all GWS versions and check them
+    for gws_version in reversed(gws_versions):
+        gv_path, av_path = [os.path.join(bdir, gws_version) for bdir in (gws_dir.dr, arc_dir.dr)]
+        logger.debug(f"[INFO] Working on: {gv_path}")
+        logger.debug(f"              and: {av_path}")
+        check_deadline(deadline, gv_path)
+
+        # If the GWS version is older than the latest archive version: delete the GWS version,
+        # or optionally replace it with a symlink if it matches the same archive version
+        if gws_version < arc_dir.latest:
+            linkable = link_old_versions and gws_version in arc_versions
+
+            if linkable and os.path.islink(gv_path):
+                logger.info(f"{gv_path} correctly points to: {av_path}")
+            elif linkable:
+                if dirs_match(gv_path, av_path, base_dir1, base_dir2, sampling=sampling, summary=summary,
+                              backend=arc_dir.backend, index=index, deadline=deadline):
+                    summary.bytes_reclaimed += dir_usage(gv_path)[2]
+                    delete_dir(gv_path)
+                    symlink(av_path, gv_path)
+                    logger.warning(f"[ACTION] Deleted {gv_path} and symlinked to older archive version: {av_path}")
                 else:
-                    logger.warning(f"    No latest link exists for {gv_path}")
-                symlink(gv_path,'latest',relative=True)                
+                    # Never delete a copy that has just been shown to differ from the archive
+                    logger.error(f"Old version differs from archive, keeping: {gv_path}")
+            elif os.path.islink(gv_path):
+                os.remove(gv_path)
+                logger.warning(f"[ACTION] Deleted symlink to older version: {gv_path}")
+            else:
+                summary.bytes_reclaimed += dir_usage(gv_path)[2]
+                delete_dir(gv_path)
+                logger.warning(f"[ACTION] Deleted old version in GWS: {gv_path}")
+
+        # If they are the same:
+        elif gws_version == arc_dir.latest:
+
+            # TODO: find a better solution than ".endswith(av_path)" - should match equivalence
+            if Path(gv_path).is_symlink(): #and Path(gv_path).readlink().as_posix().endswith(av_path):
+                logger.info(f"{gv_path} correctly points to: {av_path}")
+            elif dirs_match(gv_path, av_path, base_dir1, base_dir2, sampling=sampling, summary=summary,
+                            backend=arc_dir.backend, index=index, deadline=deadline):
+                logger.info(f"Found matching directories, so deleting and symlinking.")
+                summary.bytes_reclaimed += dir_usage(gv_path)[2]
+                delete_dir(gv_path)
+                symlink(av_path, gv_path)
+                logger.warning(f"[ACTION] Deleted {gv_path} and symlinked to: {av_path}")
+
+            logger.warning(f"    Archive latest link points to {arc_dir.latest}")
+
+            gws_latest_link=Path(gws_dir.dr + '/latest')
+            if os.path.exists(gws_latest_link):
+                logger.warning(f"    GWS latest link points to {gws_latest_link.readlink()}")
+                os.remove(gws_latest_link.as_posix())
+            else:
+                logger.warning(f"    No latest link exists for {gv_path}")
+            symlink(gv_path,'latest',relative=True)                
 
-            # If the GWS version is newer: then maybe this is ready for ingestion, or needs attention
+        # If the GWS version is newer: then maybe this is ready for ingestion, or needs attention
+        else:
+            logger.warning(f"GWS version is newer than archive dir: {gv_path} newer than {arc_dir.dr}/{arc_dir.latest}")
+            latest_link=Path(gws_dir.dr + '/latest')
+            if os.path.exists(latest_link):
+                logger.warning(f"    And latest link points to {latest_link.readlink()}")
             else:
-                logger.warning(f"GWS version is newer than archive dir: {gv_path} newer than {arc_dir.dr}/{arc_dir.latest}")
-                latest_link=Path(gws_dir.dr + '/latest')
-                if os.path.exists(latest_link):
-                    logger.warning(f"    And latest link points to {latest_link.readlink()}")
-                else:
-                    logger.warning(f"    No latest link exists for {gv_path}")
+                logger.warning(f"    No latest link exists for {gv_path}")
 
+    summary.index_hits += index.hits
 
+
+def main(base_dir1: str, base_dir2: str, order: str="walk", time_budget: float=None,
+         sampling: SamplingPolicy=None, backend: ArchiveBackend=None,
+         link_old_versions: bool=False, profiler: Profiler=None) -> RunSummary:
+    summary = RunSummary()
+    # The same index is used for the GWS side and, with the default backend, the archive side
+    index = ContentIndex()
+    backend = backend or PosixArchiveBackend(index=index)
+    profiler = profiler or Profiler()
+
+    for dr, exists in ((base_dir1, os.path.isdir), (base_dir2, backend.exists)):
+        if not exists(os.path.abspath(dr)):
+            logger.error(f"Top-level directory does not exist: {dr}")
+            return summary
+
+    # Ensure paths are absolute, not relative, so that they can be used to create symlinks
+    base_dir1 = os.path.abspath(base_dir1)
+    base_dir2 = os.path.abspath(base_dir2)
+
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+
+    with profiler.phase("identify_dirs"):
+        gws_dirs_to_check = identify_dirs(base_dir1)
+
+    if not gws_dirs_to_check:
+        logger.error(f"No content found in directory: {base_dir1}")
+
+    # In "cost" order, containers that free the most space for the least reading go first
+    if order == "cost":
+        with profiler.phase("estimate"):
+            estimates = order_by_cost(gws_dirs_to_check, base_dir1, base_dir2, backend=backend,
+                                      link_old_versions=link_old_versions)
+    else:
+        estimates = [ContainerEstimate(d1) for d1 in gws_dirs_to_check]
+
+    # Observed verification rate (cost units per second), used to skip containers
+    # that cannot finish before the deadline
+    done_cost, done_time = 0, 0.0
+
+    with profiler.phase("process"):
+        for est in estimates:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"Time budget exhausted, stopping before: {est.dr}")
+                    summary.budget_exhausted = True
+                    break
+
+                if done_cost > 0 and done_time > 0 and est.cost / (done_cost / done_time) > remaining:
+                    logger.warning(f"Skipping container that is not expected to finish within time budget: {est.dr}")
+                    summary.containers_over_budget += 1
+                    continue
+
+            start = time.monotonic()
+            try:
+                with profiler.span(f"container:{est.dr}"):
+                    process_container(est.dr, base_dir1, base_dir2, summary, sampling=sampling, backend=backend,
+                                      link_old_versions=link_old_versions, deadline=deadline,
+                                      index=index)
+            except TimeBudgetExceeded as exc:
+                logger.warning(str(exc))
+                summary.budget_exhausted = True
+                break
+
+            done_cost += est.cost
+            done_time += time.monotonic() - start
+
+    return summary
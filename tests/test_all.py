@@ -1,9 +1,19 @@
 from pathlib import Path
 import os
 import shutil
+import sys
+import time
+import tracemalloc
+
+import pytest
 
 import logging
-from symlark.symlark import main
+import symlark.symlark
+from symlark.symlark import (main, nested_list, dirs_match, process_container, RunSummary, TimeBudgetExceeded,
+                             SamplingPolicy, ArchiveBackend, CatalogueArchiveBackend, write_catalogue,
+                             estimate_container, PER_FILE_COST)
+from symlark.profiling import Profiler
+from symlark import cli
 
 TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -235,3 +245,458 @@ def test_two_archive_versions_only_old_gws_version(caplog):
     assert caplog.records[3].message == f"    Archive latest link points to {os.path.basename(av_dir2)}"
     assert caplog.records[4].message == f"    GWS latest link points to {os.path.basename(gv_dir)}"
     assert caplog.records[5].message == f"Symlinking latest to: {gv_dir2}"
+
+
+def fill_files(dr, nbytes, char="x"):
+    for fname in os.listdir(dr):
+        with open(f"{dr}/{fname}", "w") as f:
+            f.write(char * nbytes)
+
+
+def test_cost_order_processes_cheapest_reclaim_first(caplog):
+    '''Tests that "cost" ordering handles a container with only old versions to delete before one that needs verifying.'''
+    for cont in ("aaa", "bbb"):
+        setup_container_dir(f"{TEST_ARC}/{cont}", ["v20110101", "v20220203"], latest="v20220203")
+
+    # Container "aaa" needs a full comparison, container "bbb" only needs an old version deleting
+    setup_container_dir(f"{TEST_GWS}/aaa", ["v20220203"])
+    setup_container_dir(f"{TEST_GWS}/bbb", ["v20110101"])
+    fill_files(f"{TEST_GWS}/aaa/v20220203", 100)
+    fill_files(f"{TEST_ARC}/aaa/v20220203", 100)
+    fill_files(f"{TEST_GWS}/bbb/v20110101", 100)
+
+    caplog.set_level(logging.INFO)
+    summary = main(TEST_GWS, TEST_ARC, order="cost")
+
+    messages = [rec.message for rec in caplog.records]
+    deleted_old = messages.index(f"[ACTION] Deleted old version in GWS: {TEST_GWS}/bbb/v20110101")
+    symlinked = messages.index(f"[ACTION] Deleted {TEST_GWS}/aaa/v20220203 and symlinked to: {TEST_ARC}/aaa/v20220203")
+
+    assert deleted_old < symlinked
+    assert summary.containers_processed == 2
+    assert summary.bytes_reclaimed == 600
+
+
+def test_time_budget_stops_before_processing(caplog):
+    '''Tests that an exhausted time budget stops the run cleanly without touching any containers.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20220203"], latest="v20220203")
+
+    caplog.set_level(logging.INFO)
+    summary = main(TEST_GWS, TEST_ARC, time_budget=0)
+
+    assert caplog.records[0].message == f"Time budget exhausted, stopping before: {TEST_GWS}"
+    assert summary.budget_exhausted
+    assert summary.containers_processed == 0
+    assert os.path.isdir(f"{TEST_GWS}/v20220203") and not os.path.islink(f"{TEST_GWS}/v20220203")
+
+
+def test_cost_order_with_zero_cost_container_first(caplog, monkeypatch):
+    '''Tests that a zero-cost container processed first does not break the time budget rate estimate.'''
+    # Container "aaa" has no archive latest link (cost 0), container "bbb" holds zero-byte files (cost > 0)
+    setup_container_dir(f"{TEST_ARC}/aaa", ["v20220203"])
+    setup_container_dir(f"{TEST_GWS}/aaa", ["v20220203"])
+    setup_container_dir(f"{TEST_ARC}/bbb", ["v20220203"], latest="v20220203")
+    setup_container_dir(f"{TEST_GWS}/bbb", ["v20220203"])
+    monkeypatch.setattr(symlark.symlark, "identify_dirs", lambda d: [f"{TEST_GWS}/aaa", f"{TEST_GWS}/bbb"])
+
+    caplog.set_level(logging.INFO)
+    summary = main(TEST_GWS, TEST_ARC, order="cost", time_budget=1000)
+
+    assert summary.containers_invalid == 1
+    assert summary.containers_processed == 1
+    assert summary.containers_over_budget == 0
+    assert os.path.islink(f"{TEST_GWS}/bbb/v20220203")
+
+
+def test_deadline_stops_container_without_deleting(caplog):
+    '''Tests that a deadline passing inside a container stops it before anything is deleted.'''
+    setup_container_dir(TEST_ARC, ["v20110101", "v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20110101", "v20220203"], latest="v20220203")
+
+    with pytest.raises(TimeBudgetExceeded):
+        process_container(TEST_GWS, TEST_GWS, TEST_ARC, RunSummary(), deadline=time.monotonic())
+
+    for version in ("v20110101", "v20220203"):
+        assert os.path.isdir(f"{TEST_GWS}/{version}") and not os.path.islink(f"{TEST_GWS}/{version}")
+
+class FakeClock:
+    # Stands in for the time module in symlark.symlark so tests control the deadline
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.mark.parametrize("sampling", [None, SamplingPolicy(confidence=0.99, max_corruption_rate=0.5, seed=1)])
+def test_deadline_inside_dirs_match_stops_reading(sampling, monkeypatch):
+    '''Tests that the deadline is checked before each file is read, not just once per comparison.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20220203"], latest="v20220203")
+
+    clock = FakeClock()
+    monkeypatch.setattr(symlark.symlark, "time", clock)
+    hashed = []
+
+    def md5_then_pass_deadline(f, blocksize=65536):
+        hashed.append(f)
+        clock.now = 20
+        return "checksum"
+
+    monkeypatch.setattr(symlark.symlark, "md5", md5_then_pass_deadline)
+
+    with pytest.raises(TimeBudgetExceeded):
+        dirs_match(f"{TEST_GWS}/v20220203", f"{TEST_ARC}/v20220203", TEST_GWS, TEST_ARC,
+                   sampling=sampling, deadline=10)
+
+    # Only the first file was read (from both sides) before the deadline stopped the comparison
+    assert len(hashed) == 2
+
+
+def test_container_not_expected_to_finish_is_skipped(caplog, monkeypatch):
+    '''Tests that a container whose estimated cost exceeds the remaining budget is skipped.'''
+    for cont in ("aaa", "bbb"):
+        setup_container_dir(f"{TEST_ARC}/{cont}", ["v20220203"], latest="v20220203")
+        setup_container_dir(f"{TEST_GWS}/{cont}", ["v20220203"])
+    monkeypatch.setattr(symlark.symlark, "identify_dirs", lambda d: [f"{TEST_GWS}/aaa", f"{TEST_GWS}/bbb"])
+
+    # Each container takes 10 seconds, and 15 seconds are available
+    clock = FakeClock()
+    monkeypatch.setattr(symlark.symlark, "time", clock)
+
+    def slow_process_container(d1, base_dir1, base_dir2, summary, **kwargs):
+        clock.now += 10
+        summary.containers_processed += 1
+
+    monkeypatch.setattr(symlark.symlark, "process_container", slow_process_container)
+
+    caplog.set_level(logging.INFO)
+    summary = main(TEST_GWS, TEST_ARC, order="cost", time_budget=15)
+
+    assert caplog.records[-1].message == \
+        f"Skipping container that is not expected to finish within time budget: {TEST_GWS}/bbb"
+    assert summary.containers_processed == 1
+    assert summary.containers_over_budget == 1
+
+def test_sampling_policy_sample_size():
+    '''Tests that sample sizes meet the requested confidence and never exceed the number of files.'''
+    policy = SamplingPolicy(confidence=0.95, max_corruption_rate=0.01)
+
+    n_sample, confidence = policy.sample_size(100000)
+    assert 250 < n_sample < 320
+    assert confidence >= 0.95
+
+    assert policy.sample_size(10) == (10, 1.0)
+    assert policy.sample_size(0) == (0, 1.0)
+
+
+def test_sampling_matches_and_reports_confidence(caplog):
+    '''Tests that a sampled comparison of matching directories reports the confidence achieved.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20220203"], latest="v20220203")
+
+    caplog.set_level(logging.INFO)
+    summary = main(TEST_GWS, TEST_ARC, sampling=SamplingPolicy(confidence=0.5, max_corruption_rate=0.5, seed=1))
+
+    assert caplog.records[0].message == f"Sample of 1 files matched with confidence 0.6667 in: {TEST_GWS}/v20220203"
+    assert summary.containers_sampled == 1
+    assert summary.min_confidence == pytest.approx(2 / 3)
+    assert os.path.islink(f"{TEST_GWS}/v20220203")
+
+
+def test_sampling_mismatch_escalates_to_full_verification(caplog):
+    '''Tests that a checksum mismatch in the sample triggers full verification of the container.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20220203"], latest="v20220203")
+    # Every file differs in content but not in size, so any sample finds a mismatch
+    fill_files(f"{TEST_GWS}/v20220203", 1)
+    fill_files(f"{TEST_ARC}/v20220203", 1, char="y")
+
+    caplog.set_level(logging.INFO)
+    summary = main(TEST_GWS, TEST_ARC, sampling=SamplingPolicy(confidence=0.99, max_corruption_rate=0.5, seed=1))
+
+    messages = [rec.message for rec in caplog.records]
+    assert messages[0] == f"Checksum mismatch in sample, escalating to full verification: {TEST_GWS}/v20220203"
+    assert messages[1] == f"Files differ in MD5: {TEST_GWS}/v20220203/file_1.nc vs {TEST_ARC}/v20220203/file_1.nc"
+    assert summary.sample_escalations == 1
+    assert not os.path.islink(f"{TEST_GWS}/v20220203")
+
+
+def test_nested_list_keeps_subdirectories():
+    '''Tests that nested files are listed relative to the top directory.'''
+    check_dir(f"{TEST_GWS}/sub")
+    create_files(TEST_GWS, fnames=["a.nc"])
+    create_files(f"{TEST_GWS}/sub", fnames=["b.nc"])
+
+    assert nested_list(TEST_GWS, remove_base=TEST_GWS) == ["a.nc", "sub/b.nc"]
+
+
+def test_catalogue_backend_compares_without_reading_archive(caplog, monkeypatch):
+    '''Tests that a JSON catalogue provides archive listings and checksums without touching archive files.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20220203"], latest="v20220203")
+    fill_files(f"{TEST_ARC}/v20220203", 10)
+    fill_files(f"{TEST_GWS}/v20220203", 10)
+
+    catalogue = f"{TEST_DATA}/catalogue.json"
+    write_catalogue(TEST_ARC, catalogue)
+    backend = CatalogueArchiveBackend(catalogue)
+
+    assert backend.versions(TEST_ARC) == ["v20220203"]
+    assert backend.latest(TEST_ARC) == "v20220203"
+    assert backend.list_files(f"{TEST_ARC}/v20220203") == {f"file_{i}.nc": 10 for i in (1, 2, 3)}
+
+    # Only the catalogue may answer for the archive side
+    gws_md5 = symlark.symlark.md5
+
+    def md5_gws_only(f, blocksize=65536):
+        assert not f.startswith(TEST_ARC), f"Archive file was read: {f}"
+        return gws_md5(f, blocksize)
+
+    monkeypatch.setattr(symlark.symlark, "md5", md5_gws_only)
+
+    caplog.clear()
+    caplog.set_level(logging.INFO)
+    main(TEST_GWS, TEST_ARC, backend=backend)
+
+    assert caplog.records[0].message == "Found matching directories, so deleting and symlinking."
+    assert os.readlink(f"{TEST_GWS}/v20220203") == f"{TEST_ARC}/v20220203"
+    assert sorted(os.listdir(f"{TEST_GWS}/v20220203")) == ["file_1.nc", "file_2.nc", "file_3.nc"]
+
+
+def test_cli_writes_catalogue(monkeypatch, capsys):
+    '''Tests that the catalogue used by --catalogue can be built from the command line.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    catalogue = f"{TEST_DATA}/catalogue.json"
+    monkeypatch.setattr(sys, "argv", ["symlark", "--write-catalogue", catalogue, TEST_ARC])
+
+    cli.main()
+
+    assert CatalogueArchiveBackend(catalogue).latest(TEST_ARC) == "v20220203"
+    assert capsys.readouterr().out == f"Catalogue written to: {catalogue}\n"
+
+
+@pytest.mark.parametrize("content", [None, "{not json", "[]"])
+def test_cli_rejects_unreadable_catalogue(content, monkeypatch, capsys):
+    '''Tests that a missing or invalid catalogue is reported as a usage error.'''
+    catalogue = f"{TEST_DATA}/catalogue.json"
+    if content is not None:
+        check_dir(TEST_DATA)
+        with open(catalogue, "w") as writer:
+            writer.write(content)
+    monkeypatch.setattr(sys, "argv", ["symlark", TEST_GWS, TEST_ARC, "--catalogue", catalogue])
+
+    with pytest.raises(SystemExit) as exc:
+        cli.main()
+
+    assert exc.value.code == 2
+    assert f"Cannot read catalogue {catalogue}" in capsys.readouterr().err
+
+
+def test_incomplete_archive_backend_cannot_be_created():
+    '''Tests that a backend missing part of the interface fails when it is created.'''
+    class ListingOnlyBackend(ArchiveBackend):
+        def list_files(self, version_dir):
+            return {}
+
+    with pytest.raises(TypeError):
+        ListingOnlyBackend()
+
+def test_identical_files_are_not_hashed(caplog):
+    '''Tests that hardlinks and symlinks to the archive copy are matched without calculating checksums.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    fill_files(f"{TEST_ARC}/v20220203", 10)
+
+    gv_dir, av_dir = f"{TEST_GWS}/v20220203", f"{TEST_ARC}/v20220203"
+    check_dir(gv_dir)
+    os.link(f"{av_dir}/file_1.nc", f"{gv_dir}/file_1.nc")
+    os.symlink(f"{av_dir}/file_2.nc", f"{gv_dir}/file_2.nc")
+    shutil.copy(f"{av_dir}/file_3.nc", f"{gv_dir}/file_3.nc")
+
+    caplog.set_level(logging.DEBUG)
+    summary = main(TEST_GWS, TEST_ARC)
+
+    hashed = [rec.message for rec in caplog.records if rec.message.startswith("Calculating MD5 checksum for:")]
+    assert sorted(hashed) == [f"Calculating MD5 checksum for: {av_dir}/file_3.nc",
+                              f"Calculating MD5 checksum for: {gv_dir}/file_3.nc"]
+    assert summary.same_inode_matches == 1
+    assert summary.archive_link_matches == 1
+    # Only the copied file frees space, the hardlink and symlink do not
+    assert summary.bytes_reclaimed == 10
+    assert os.path.islink(gv_dir)
+
+
+def test_old_matching_versions_linked_using_content_index(caplog):
+    '''Tests that an older GWS version matching the older archive version is symlinked without rereading unchanged files.'''
+    for dr in (TEST_ARC, TEST_GWS):
+        setup_container_dir(dr, ["v20110101"], latest="v20220203")
+        fill_files(f"{dr}/v20110101", 10)
+        # The newer version shares the same (hardlinked) files as the older one
+        check_dir(f"{dr}/v20220203")
+        for fname in os.listdir(f"{dr}/v20110101"):
+            os.link(f"{dr}/v20110101/{fname}", f"{dr}/v20220203/{fname}")
+
+    caplog.set_level(logging.DEBUG)
+    summary = main(TEST_GWS, TEST_ARC, link_old_versions=True)
+
+    hashed = [rec.message for rec in caplog.records if rec.message.startswith("Calculating MD5 checksum for:")]
+    assert len(hashed) == 6
+    assert summary.index_hits == 6
+
+    gv_dir, av_dir = f"{TEST_GWS}/v20110101", f"{TEST_ARC}/v20110101"
+    assert f"[ACTION] Deleted {gv_dir} and symlinked to older archive version: {av_dir}" in [rec.message for rec in caplog.records]
+    assert os.readlink(gv_dir) == av_dir
+    assert os.path.islink(f"{TEST_GWS}/v20220203")
+
+
+def test_profiler_writes_phase_profiles_and_collapsed_stacks():
+    '''Tests that profiling writes cProfile output, collapsed stacks and per-container timing spans.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20220203"], latest="v20220203")
+
+    profile_dir = f"{TEST_DATA}/profile"
+    profiler = Profiler(profile_dir, trace_malloc=True)
+    main(TEST_GWS, TEST_ARC, profiler=profiler)
+    written = profiler.close()
+
+    for name in ("identify_dirs.prof", "identify_dirs.collapsed", "process.prof", "process.collapsed",
+                 "process.tracemalloc", "spans.collapsed"):
+        assert f"{profile_dir}/{name}" in written
+        assert os.path.isfile(f"{profile_dir}/{name}")
+
+    with open(f"{profile_dir}/process.collapsed") as reader:
+        stacks = [line.rsplit(" ", 1) for line in reader]
+    assert any("symlark.py:md5" in stack for stack, micros in stacks)
+    assert all(int(micros) > 0 for stack, micros in stacks)
+
+    with open(f"{profile_dir}/spans.collapsed") as reader:
+        spans = [line.rsplit(" ", 1)[0] for line in reader]
+    assert f"symlark;process;container:{TEST_GWS}" in spans
+
+
+def test_profiler_disabled_writes_nothing():
+    '''Tests that a profiler without an output directory records nothing.'''
+    profiler = Profiler()
+    with profiler.phase("identify_dirs"):
+        with profiler.span("container"):
+            pass
+
+    assert profiler.close() == []
+
+
+@pytest.mark.parametrize("args", [["--sample-confidence", "1"],
+                                  ["--sample-confidence", "0.9", "--max-corruption-rate", "0"],
+                                  ["--max-corruption-rate", "0.1"],
+                                  ["--profile-memory"]])
+def test_cli_rejects_invalid_options(args, monkeypatch, capsys):
+    '''Tests that invalid or incomplete sampling and profiling options are reported as usage errors.'''
+    monkeypatch.setattr(sys, "argv", ["symlark", TEST_GWS, TEST_ARC] + args)
+
+    with pytest.raises(SystemExit) as exc:
+        cli.main()
+
+    assert exc.value.code == 2
+    assert "error:" in capsys.readouterr().err
+
+
+def test_old_version_that_differs_is_kept(caplog):
+    '''Tests that with linking of old versions enabled, an old version that fails verification is not deleted.'''
+    setup_container_dir(TEST_ARC, ["v20110101", "v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20110101"], latest="v20220203", arc_links={"v20220203": "v20220203"})
+    fill_files(f"{TEST_GWS}/v20110101", 10)
+
+    caplog.set_level(logging.INFO)
+    main(TEST_GWS, TEST_ARC, link_old_versions=True)
+
+    gv_dir = f"{TEST_GWS}/v20110101"
+    assert caplog.records[-1].message == f"Old version differs from archive, keeping: {gv_dir}"
+    assert os.path.isdir(gv_dir) and not os.path.islink(gv_dir)
+
+
+def test_estimate_costs_old_versions_when_linking():
+    '''Tests that older versions are costed as fully verified when they will be linked rather than deleted.'''
+    setup_container_dir(TEST_ARC, ["v20110101", "v20220203"], latest="v20220203")
+    setup_container_dir(TEST_GWS, ["v20110101"])
+    fill_files(f"{TEST_GWS}/v20110101", 10)
+
+    deleted = estimate_container(TEST_GWS, TEST_ARC)
+    linked = estimate_container(TEST_GWS, TEST_ARC, link_old_versions=True)
+
+    assert deleted.cost == 3
+    assert linked.cost == 2 * 30 + 3 * PER_FILE_COST
+    assert deleted.reclaimable == linked.reclaimable == 30
+
+
+def test_tracemalloc_snapshots_are_per_phase():
+    '''Tests that each phase's tracemalloc snapshot excludes allocations from earlier phases.'''
+    profile_dir = f"{TEST_DATA}/profile"
+    profiler = Profiler(profile_dir, trace_malloc=True)
+
+    with profiler.phase("identify_dirs"):
+        kept = [bytearray(1024) for i in range(1000)]
+    with profiler.phase("process"):
+        pass
+    profiler.close()
+
+    def traced_bytes(name):
+        return sum(stat.size for stat in tracemalloc.Snapshot.load(f"{profile_dir}/{name}.tracemalloc").statistics("filename"))
+
+    assert traced_bytes("identify_dirs") > 1024 * 1000
+    assert traced_bytes("process") < 1024 * 1000
+
+
+def test_cli_writes_profile_when_run_fails(monkeypatch):
+    '''Tests that profiles are still written when the run raises an error.'''
+    profile_dir = f"{TEST_DATA}/profile"
+    monkeypatch.setattr(sys, "argv", ["symlark", TEST_GWS, TEST_ARC, "--profile", profile_dir])
+
+    def failing_main(*args, profiler=None, **kwargs):
+        with profiler.phase("process"):
+            raise RuntimeError("failed run")
+
+    monkeypatch.setattr(cli, "symlark_main", failing_main)
+
+    with pytest.raises(RuntimeError):
+        cli.main()
+
+    assert os.path.isfile(f"{profile_dir}/process.prof")
+
+
+def test_hardlinked_gws_versions_are_reclaimable():
+    '''Tests that GWS versions hardlinked to each other count as reclaimable when both are removed.'''
+    setup_container_dir(TEST_ARC, ["v20220203"], latest="v20220203")
+    fill_files(f"{TEST_ARC}/v20220203", 1000)
+    setup_container_dir(TEST_GWS, ["v20110101"])
+    fill_files(f"{TEST_GWS}/v20110101", 1000)
+    check_dir(f"{TEST_GWS}/v20220203")
+    for fname in os.listdir(f"{TEST_GWS}/v20110101"):
+        os.link(f"{TEST_GWS}/v20110101/{fname}", f"{TEST_GWS}/v20220203/{fname}")
+
+    assert estimate_container(TEST_GWS, TEST_ARC).reclaimable == 3000
+
+    summary = main(TEST_GWS, TEST_ARC)
+
+    assert summary.bytes_reclaimed == 3000
+    assert os.path.islink(f"{TEST_GWS}/v20220203")
+    assert not os.path.exists(f"{TEST_GWS}/v20110101")
+
+
+def test_profiler_leaves_caller_tracing_running():
+    '''Tests that the profiler only stops tracemalloc if it started it.'''
+    profiler = Profiler(f"{TEST_DATA}/profile", trace_malloc=True)
+    tracemalloc.start()
+    try:
+        with profiler.phase("process"):
+            pass
+        profiler.close()
+
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+    with profiler.phase("process"):
+        pass
+    profiler.close()
+
+    assert not tracemalloc.is_tracing()